@@ -2,68 +2,80 @@ import math
 import numpy as np
 import pandas as pd
 import os
-import csv
+import importlib.util
 from tqdm import tqdm
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader
 # 在导入部分新增
-from sklearn.ensemble import RandomForestRegressor
+import numba
+from numba import njit, prange
 from sklearn.inspection import permutation_importance
 # For plotting learning curve
 from torch.utils.tensorboard import SummaryWriter
 
 
 def same_seed(seed):
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
     np.random.seed(seed)
     torch.manual_seed(seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(seed)
+    # 模型只有Linear层, 确定性卷积算法没有意义; 打开autotuner和TF32加速矩阵乘
+    torch.backends.cudnn.deterministic = False
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
 
 
 def train_valid_split(data_set, valid_ratio, seed):
+    # 直接在numpy数组上按随机排列切分, 不经过random_split的Subset包装
     valid_set_size = int(valid_ratio * len(data_set))
-    train_set_size = len(data_set) - valid_set_size
-    train_set, valid_set = random_split(data_set, [train_set_size, valid_set_size],
-                                        generator=torch.Generator().manual_seed(seed))
-    return np.array(train_set), np.array(valid_set)
+    perm = np.random.default_rng(seed).permutation(len(data_set))
+    return data_set[perm[valid_set_size:]], data_set[perm[:valid_set_size]]
 
 
 def predict(test_loader, model, device):
     model.eval()  # Set your model to evaluation mode.
-    preds = []
-    for x in tqdm(test_loader):
-        x = x.to(device)
+    # 预先分配(锁页)的输出, 每个batch异步拷贝到对应切片, 不再逐batch .cpu() 再 torch.cat
+    preds = torch.empty(len(test_loader.dataset), 1, pin_memory=torch.cuda.is_available())
+    offset = 0
+    for x in tqdm(CudaPrefetcher(test_loader, device)):
         with torch.no_grad():
-            pred = model(x)
-            preds.append(pred.detach().cpu())
-    preds = torch.cat(preds, dim=0).numpy()
-    return preds
+            pred = model(x).mean(dim=0)
+            preds[offset:offset + len(pred)].copy_(pred, non_blocking=True)
+        offset += len(pred)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return preds.numpy()[:, 0]
 
 def save_pred(preds, file):
     ''' Save predictions to specified file '''
-    with open(file, 'w') as fp:
-        writer = csv.writer(fp)
-        writer.writerow(['id', 'tested_positive'])
-        for i, p in enumerate(preds):
-            writer.writerow([i, p])
+    pd.DataFrame({'id': np.arange(len(preds)), 'tested_positive': preds}).to_csv(file, index=False)
 
 class My_model(nn.Module):
-    def __init__(self, input_dim):
+    '''
+    n_replicas个相同结构的MLP (input_dim -> 16 -> 8 -> 1) 批量放在一起训练, 权重形状为 [K, in, out]
+    每层对所有replica只做一次einsum, 输出 [K, B, 1], 预测时对K个replica取平均即为集成结果
+    '''
+
+    def __init__(self, input_dim, n_replicas=1):
         super(My_model, self).__init__()
-        self.layers = nn.Sequential(
-            nn.Linear(input_dim, 16),
-            nn.ReLU(),
-            nn.Linear(16, 8),
-            nn.ReLU(),
-            nn.Linear(8, 1),
-        )
+        dims = [input_dim, 16, 8, 1]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for in_dim, out_dim in zip(dims[:-1], dims[1:]):
+            # 与nn.Linear默认初始化相同: U(-1/sqrt(in_dim), 1/sqrt(in_dim))
+            bound = 1 / math.sqrt(in_dim)
+            self.weights.append(nn.Parameter(torch.empty(n_replicas, in_dim, out_dim).uniform_(-bound, bound)))
+            self.biases.append(nn.Parameter(torch.empty(n_replicas, 1, out_dim).uniform_(-bound, bound)))
 
     def forward(self, x):
-        x = self.layers(x)
-        x = x.squeeze(1)
+        # 同一个batch广播给所有replica: [B, in] -> [K, B, in]
+        x = x.expand(self.weights[0].shape[0], -1, -1)
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            x = torch.einsum('kbi,kio->kbo', x, w) + b
+            if i < len(self.weights) - 1:
+                x = torch.relu(x)
         return x
 
 
@@ -78,7 +90,7 @@ class COVID19Dataset(Dataset):
         if y is None:
             self.y = y
         else:
-            self.y = torch.FloatTensor(y)
+            self.y = torch.FloatTensor(y).unsqueeze(1)
         self.x = torch.FloatTensor(x)
 
     def __getitem__(self, idx):
@@ -90,88 +102,399 @@ class COVID19Dataset(Dataset):
     def __len__(self):
         return len(self.x)
 
+# 用numba实现的回归随机森林, 只用于计算特征重要性
+@njit(cache=True)
+def _best_split(X, y, w, order, node_of, n_nodes):
+    """
+    对当前层的所有节点同时寻找最优切分
+    order为每一列预先排好序的样本索引, 按顺序扫描即可得到每个节点的左子树统计量
+    返回每个节点的方差减少量(按样本数加权)、切分特征和阈值(x <= 阈值的样本进入左子树)
+    """
+    n_samples, n_features = X.shape
+    tot_w = np.zeros(n_nodes)
+    tot_s = np.zeros(n_nodes)
+    for i in range(n_samples):
+        k = node_of[i]
+        if k >= 0:
+            tot_w[k] += w[i]
+            tot_s[k] += w[i] * y[i]
+
+    best_gain = np.zeros(n_nodes)
+    best_feat = np.full(n_nodes, -1)
+    best_thr = np.zeros(n_nodes)
+    left_w = np.zeros(n_nodes)
+    left_s = np.zeros(n_nodes)
+    last = np.zeros(n_nodes)
+    for f in range(n_features):
+        left_w[:] = 0.0
+        left_s[:] = 0.0
+        for j in range(n_samples):
+            i = order[j, f]
+            k = node_of[i]
+            if k < 0 or w[i] == 0:
+                continue
+            v = X[i, f]
+            if left_w[k] > 0 and v > last[k]:
+                right_w = tot_w[k] - left_w[k]
+                right_s = tot_s[k] - left_s[k]
+                gain = left_s[k] ** 2 / left_w[k] + right_s ** 2 / right_w - tot_s[k] ** 2 / tot_w[k]
+                if gain > best_gain[k]:
+                    best_gain[k] = gain
+                    best_feat[k] = f
+                    best_thr[k] = last[k]
+            left_w[k] += w[i]
+            left_s[k] += w[i] * y[i]
+            last[k] = v
+    return best_gain, best_feat, best_thr
+
+
+@njit(cache=True)
+def _build_tree(X, y, w, order, max_depth):
+    """
+    逐层构建一棵深度为max_depth的回归树, 返回该树的特征重要性(归一化)
+    """
+    n_samples, n_features = X.shape
+    importance = np.zeros(n_features)
+    node_of = np.zeros(n_samples, dtype=np.int64)
+    n_nodes = 1
+    for depth in range(max_depth):
+        gain, feat, thr = _best_split(X, y, w, order, node_of, n_nodes)
+        child = np.full(n_nodes, -1)
+        n_children = 0
+        for k in range(n_nodes):
+            if feat[k] >= 0:
+                child[k] = n_children
+                n_children += 2
+                importance[feat[k]] += gain[k]
+        if n_children == 0:
+            break
+        for i in range(n_samples):
+            k = node_of[i]
+            if k < 0:
+                continue
+            if child[k] < 0:
+                node_of[i] = -1
+            elif X[i, feat[k]] <= thr[k]:
+                node_of[i] = child[k]
+            else:
+                node_of[i] = child[k] + 1
+        n_nodes = n_children
+    total = importance.sum()
+    if total > 0:
+        importance /= total
+    return importance
+
+
+@njit(parallel=True, cache=True)
+def _fit_forest(X, y, weights, order, max_depth):
+    n_trees = weights.shape[0]
+    importances = np.zeros((n_trees, X.shape[1]))
+    for t in prange(n_trees):
+        importances[t] = _build_tree(X, y, weights[t], order, max_depth)
+    return importances
+
+
+@njit('float64[:](float32[:, :], float32[:])', parallel=True, cache=True)
+def _rank_features(X, y):
+    """
+    快速特征打分: 每一列与y的皮尔逊相关系数的绝对值, 各列并行计算, 用于随机森林之前的预筛选
+    """
+    n_samples, n_features = X.shape
+    y_mean = 0.0
+    for i in range(n_samples):
+        y_mean += y[i]
+    y_mean /= n_samples
+    y_var = 0.0
+    for i in range(n_samples):
+        y_var += (y[i] - y_mean) ** 2
+    scores = np.zeros(n_features)
+    for f in prange(n_features):
+        x_mean = 0.0
+        for i in range(n_samples):
+            x_mean += X[i, f]
+        x_mean /= n_samples
+        cov, x_var = 0.0, 0.0
+        for i in range(n_samples):
+            dx = X[i, f] - x_mean
+            cov += dx * (y[i] - y_mean)
+            x_var += dx * dx
+        if x_var > 0 and y_var > 0:
+            scores[f] = abs(cov) / np.sqrt(x_var * y_var)
+    return scores
+
+
+class NumbaForestRegressor:
+    '''
+    只提供feature_importances_的随机森林, 接口与sklearn的RandomForestRegressor保持一致
+    每棵树用有放回抽样的样本计数作为权重, 因此各列只需在fit时排序一次
+    '''
+
+    def __init__(self, n_estimators=100, max_depth=5, random_state=None, n_jobs=-1, max_samples=None):
+        self.n_estimators = n_estimators
+        self.max_depth = max_depth
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.max_samples = max_samples
+
+    def fit(self, x, y):
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        y = np.ascontiguousarray(y, dtype=np.float64)
+        n_samples = x.shape[0]
+        n_draws = n_samples if self.max_samples is None else max(1, int(round(self.max_samples * n_samples)))
+        rng = np.random.default_rng(self.random_state)
+        weights = rng.multinomial(n_draws, np.full(n_samples, 1.0 / n_samples), size=self.n_estimators).astype(np.float64)
+        order = np.argsort(x, axis=0, kind='stable')
+        if self.n_jobs is not None and self.n_jobs > 0:
+            numba.set_num_threads(min(self.n_jobs, numba.config.NUMBA_NUM_THREADS))
+        importance = _fit_forest(x, y, weights, order, self.max_depth).mean(axis=0)
+        # 没有找到切分的树贡献全0, 与sklearn一样平均后再归一化一次
+        total = importance.sum()
+        if total > 0:
+            importance /= total
+        self.feature_importances_ = importance
+        return self
+
+
+# 在side stream上提前把下一个batch拷到GPU, 与当前batch的计算重叠
+class CudaPrefetcher:
+    '''
+    loader: DataLoader with pin_memory=True, each batch is a tensor.
+    Yields batches already on device; falls back to a plain copy when CUDA is unavailable.
+    '''
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if not torch.cuda.is_available():
+            for batch in self.loader:
+                yield batch.to(self.device)
+            return
+        stream = torch.cuda.Stream()
+        batch, first = None, True
+        for next_batch in self.loader:
+            with torch.cuda.stream(stream):
+                next_batch = next_batch.to(self.device, non_blocking=True)
+            if not first:
+                yield batch
+            first = False
+            torch.cuda.current_stream().wait_stream(stream)
+            next_batch.record_stream(torch.cuda.current_stream())
+            batch = next_batch
+        if not first:
+            yield batch
+
+
 # 在select_feat函数前添加特征重要性评估
 def feature_importance(x_train, y_train, n_features=20):
     """
-    使用随机森林评估特征重要性并返回排序后的特征索引
+    使用随机森林评估特征重要性, 只训练一次随机森林
+    返回完整的特征重要性数组以及排序后的特征索引
     """
     # 转换为numpy数组
     x_np = x_train.cpu().numpy() if isinstance(x_train, torch.Tensor) else x_train
     y_np = y_train.cpu().numpy() if isinstance(y_train, torch.Tensor) else y_train
 
-    # 训练随机森林
-    rf = RandomForestRegressor(n_estimators=100, random_state=config['seed'], max_depth=5)
+    # 训练随机森林 (numba并行建树)
+    rf = NumbaForestRegressor(**config2['rf_params'])
     rf.fit(x_np, y_np)
 
     # 获取特征重要性
     importance = rf.feature_importances_
 
-    # 排序特征
-    sorted_idx = importance.argsort()
+    # 排序特征 (重要性从高到低)
+    sorted_idx = importance.argsort()[::-1]
 
-    return sorted_idx[-n_features:] if n_features else sorted_idx[::-1]
+    return importance, sorted_idx[:n_features] if n_features else sorted_idx
 
 # 修改select_feat函数
 def select_feat(train_data, valid_data, test_data):
     y_train, y_valid = train_data[:, -1], valid_data[:, -1]
     raw_x_train, raw_x_valid, raw_x_test = train_data[:, :-1], valid_data[:, :-1], test_data
 
-    sorted_idx = feature_importance(
-        torch.FloatTensor(raw_x_train),
-        torch.FloatTensor(y_train)
-    )
+    # 先按相关系数预筛选出候选特征, 随机森林只在候选特征上训练
+    candidates = np.arange(raw_x_train.shape[1])
+    if config2['corr_prefilter']:
+        # _rank_features按float32签名编译, 其他dtype要先转换
+        scores = _rank_features(np.asarray(raw_x_train, dtype=np.float32), np.asarray(y_train, dtype=np.float32))
+        candidates = np.sort(scores.argsort()[::-1][:config2['corr_prefilter']])
+    rf_importance, rf_idx = feature_importance(raw_x_train[:, candidates], y_train, n_features=config2['top_n'])
 
-    feat_idx = sorted_idx[:20]
+    # 映射回原始列号, 未进入候选的特征重要性为0
+    importance = np.zeros(raw_x_train.shape[1])
+    importance[candidates] = rf_importance
+    feat_idx = candidates[rf_idx]
 
-    return raw_x_train[:, feat_idx], raw_x_valid[:, feat_idx], raw_x_test[:, feat_idx], y_train, y_valid
+    return raw_x_train[:, feat_idx], raw_x_valid[:, feat_idx], raw_x_test[:, feat_idx], y_train, y_valid, importance
 
 
-def trainer(train_loader, valid_loader, model, config, device):
-    criterion = nn.MSELoss(reduction='mean')
-    optimizer = torch.optim.SGD(model.parameters(), lr=config['learning_rate'], momentum=0.7)
+def compile_model(model, sample_x):
+    '''
+    torch.compile the model, falling back to the eager module when compilation is not available.
+    sample_x: one training batch, used for a trial forward/backward so backend errors show up here
+    instead of in the middle of make_train_step.
+    '''
+    # Windows上较老的torch没有可用的torch.compile; 新版本在CUDA上依赖Triton, 而Windows的PyTorch wheel不带Triton
+    if not hasattr(torch, 'compile'):
+        return model
+    if sample_x.is_cuda and importlib.util.find_spec('triton') is None:
+        print('Triton is not available, training with the eager model.')
+        return model
+    compiled = torch.compile(model, fullgraph=True)
+    try:
+        # torch.compile是惰性编译, 用与训练相同的autocast设置先跑一次forward+backward
+        with torch.autocast(sample_x.device.type, dtype=torch.bfloat16, enabled=sample_x.is_cuda):
+            out = compiled(sample_x)
+        out.float().sum().backward()
+    except Exception as e:
+        print(f'torch.compile failed ({type(e).__name__}: {e}), training with the eager model.')
+        return model
+    finally:
+        model.zero_grad(set_to_none=True)
+    return compiled
+
+
+def make_train_step(model, criterion, optimizer, X, Y, batch_size):
+    '''
+    Returns step(idx) -> loss running forward, backward and optimizer.step() on the rows idx of X, Y.
+    On CUDA the whole step is captured into a CUDA graph once, so each call only gathers the batch
+    straight into static buffers and replays the graph. idx must always hold batch_size rows.
+    The warm-up steps needed before capture are undone, so training starts from the initial model and optimizer state.
+    Forward and loss run under bfloat16 autocast on CUDA; parameters and optimizer state stay float32.
+    '''
+    def eager_step(x, y):
+        optimizer.zero_grad(set_to_none=True)
+        with torch.autocast(x.device.type, dtype=torch.bfloat16, enabled=x.is_cuda):
+            loss = criterion(model(x), y)
+        loss.backward()
+        optimizer.step()
+        return loss.detach()
+
+    if not X.is_cuda:
+        def indexed_step(idx):
+            return eager_step(X.index_select(0, idx), Y.index_select(0, idx))
+        return indexed_step
+
+    static_x, static_y = X[:batch_size].clone(), Y[:batch_size].clone()
+    # warmup会真实地更新参数, 先保存初始参数, 捕获完成后再恢复
+    init_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+    # 捕获前先在side stream上warmup几步 (同时完成torch.compile的编译)
+    side_stream = torch.cuda.Stream()
+    side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream):
+        for _ in range(3):
+            eager_step(static_x, static_y)
+    torch.cuda.current_stream().wait_stream(side_stream)
+
+    graph = torch.cuda.CUDAGraph()
+    optimizer.zero_grad(set_to_none=True)
+    with torch.cuda.graph(graph):
+        with torch.autocast('cuda', dtype=torch.bfloat16):
+            static_loss = criterion(model(static_x), static_y)
+        static_loss.backward()
+        optimizer.step()
+
+    # 恢复warmup之前的状态, 都是原地拷贝, graph里记录的tensor地址不变:
+    # 参数用model.load_state_dict原地copy_; optimizer的状态(step, exp_avg, exp_avg_sq)是warmup时才创建的,
+    # 原地清零即等价于全新的optimizer (optimizer.load_state_dict会分配新tensor, 不能用)
+    model.load_state_dict(init_state)
+    for param_state in optimizer.state.values():
+        for v in param_state.values():
+            if torch.is_tensor(v):
+                v.zero_()
+
+    def graphed_step(idx):
+        # 直接gather到graph的静态输入里, 不再先index_select出新tensor再copy_
+        torch.index_select(X, 0, idx, out=static_x)
+        torch.index_select(Y, 0, idx, out=static_y)
+        graph.replay()
+        return static_loss.detach()
+
+    return graphed_step
+
+
+def trainer(train_data, valid_data, model, config, device):
+    '''
+    train_data / valid_data: (X, Y) tensors already on device, batches are sliced directly without a DataLoader
+    '''
+    mse = nn.MSELoss(reduction='mean')
+
+    def criterion(pred, y):
+        # pred: [K, B, 1], y: [B, 1], 每个replica都和同一个target比较
+        return mse(pred, y.expand_as(pred))
+
+    # CUDA graph里的optimizer.step()要求capturable=True, lr用tensor存放, scheduler修改时原地fill_, graph replay能读到新值
+    capturable = torch.device(device).type == 'cuda'
+    lr = torch.tensor(config['learning_rate'], device=device) if capturable else config['learning_rate']
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=config['weight_decay'], capturable=capturable)
+    # base lr用float, 否则旧版本torch的scheduler会直接引用(随后被fill_修改的)lr tensor
+    for group in optimizer.param_groups:
+        group['initial_lr'] = config['learning_rate']
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=config['n_epochs'])
     writer = SummaryWriter()
     if not os.path.isdir('./models'):
         os.mkdir('./models')
     n_epochs, best_loss, step, early_stop_count = config['n_epochs'], math.inf, 0, 0
-    for epoch in range(n_epochs):
+    best_state = None
+    (X_train, Y_train), (X_valid, Y_valid) = train_data, valid_data
+    n_train, bs = len(X_train), config['batch_size']
+    # CUDA graph要求固定形状, 每个epoch丢掉不满一个batch的尾部 (每个epoch重新shuffle, 所有样本都会被用到)
+    train_step = make_train_step(model, criterion, optimizer, X_train, Y_train, bs)
+    train_loss_sum = torch.zeros((), device=device)
+    epoch_pbar = tqdm(range(n_epochs), position=0, leave=True)
+    for epoch in epoch_pbar:
         model.train()
-        loss_record = []
-        train_pbar = tqdm(train_loader, position=0, leave=True)
-        for x, y in train_pbar:
-            optimizer.zero_grad()
-            x, y = x.to(device), y.to(device)
-            pred = model(x)
-            loss = criterion(pred, y)
-            loss.backward()
-            optimizer.step()
+        # loss按样本数加权在GPU上累加, 每个epoch只调用一次.item()同步
+        train_loss_sum.zero_()
+        n_train_samples = 0
+        perm = torch.randperm(n_train, device=device)
+        for i in range(0, n_train - bs + 1, bs):
+            idx = perm[i:i + bs]
+            loss = train_step(idx)
             step += 1
-            loss_record.append(loss.detach().item())
-            train_pbar.set_description(f'Epoch [{epoch + 1}/{n_epochs}]')
-            train_pbar.set_postfix({'loss': loss.detach().item()})
-        mean_train_loss = sum(loss_record) / len(loss_record)
-        writer.add_scalar('Loss/train', mean_train_loss, step)
+            train_loss_sum += loss * idx.size(0)
+            n_train_samples += idx.size(0)
+        scheduler.step()
+        if capturable:
+            # 旧版本torch的scheduler会把param_group['lr']替换成float, graph里读的仍是原来的lr tensor;
+            # 每个epoch把新的lr原地写回这个tensor, 保证cosine schedule在任何版本下都生效
+            lr.fill_(float(scheduler.get_last_lr()[0]))
+            optimizer.param_groups[0]['lr'] = lr
+        # 各replica各自的训练loss的平均
+        mean_replica_train_loss = (train_loss_sum / n_train_samples).item()
+        writer.add_scalar('Loss/train_replicas', mean_replica_train_loss, step)
 
         model.eval()
-        for x, y in valid_loader:
-            x, y = x.to(device), y.to(device)
-            with torch.no_grad():
-                pred = model(x)
-                loss = criterion(pred, y)
-            loss_record.append(loss.item())
-        mean_valid_loss = sum(loss_record) / len(loss_record)
-        print(f'Epoch [{epoch + 1}/{n_epochs}]: Train loss: {mean_train_loss:.4f}, Valid loss: {mean_valid_loss:.4f}')
+        # 训练集/验证集整体都在GPU上, 各一次forward; 都用K个replica的平均预测(集成)计算, 两条曲线可直接比较
+        # 验证集的集成loss用于early stop
+        with torch.no_grad():
+            mean_train_loss = mse(model(X_train).mean(dim=0), Y_train).item()
+            mean_valid_loss = mse(model(X_valid).mean(dim=0), Y_valid).item()
+        epoch_pbar.set_postfix(train=mean_train_loss, valid=mean_valid_loss)
+        writer.add_scalar('Loss/train', mean_train_loss, step)
         writer.add_scalar('Loss/valid', mean_valid_loss, step)
         if mean_valid_loss < best_loss:
             best_loss = mean_valid_loss
-            torch.save(model.state_dict(), config['save_path'])  # Save your best model
-            print('Saving model with loss {:.3f}...'.format(best_loss))
+            # 最优参数先保存在内存里, 训练结束时再写一次磁盘
+            # torch.compile包装后的模型要取原模型的参数, 否则key会带_orig_mod前缀
+            best_state = {k: v.detach().clone() for k, v in getattr(model, '_orig_mod', model).state_dict().items()}
             early_stop_count = 0
         else:
             early_stop_count += 1
 
         if early_stop_count >= config['early_stop']:
-            print('\nModel is not improving, so we halt the training session.')
-            return
+            epoch_pbar.write('\nModel is not improving, so we halt the training session.')
+            break
+
+    if best_state is None:
+        # 例如valid loss从第一个epoch起就是NaN
+        raise RuntimeError(f'Valid loss never improved (last valid loss: {mean_valid_loss}), no model to save.')
+    torch.save(best_state, config['save_path'])  # Save your best model
+    print('Saving model with loss {:.3f}...'.format(best_loss))
 
 
 device = 'cuda'
@@ -179,73 +502,74 @@ config = {
     'seed': 5201314,
     'select_all': True,
     'valid_ratio': 0.2,
-    'n_epochs': 5000,
+    'n_epochs': 500,
     'batch_size': 256,
-    'learning_rate': 1e-5,
-    'early_stop': 600,
+    'learning_rate': 1e-3,
+    'weight_decay': 1e-4,
+    'early_stop': 50,
+    'n_replicas': 8,  # 同时训练的模型个数, 预测时取平均
     'save_path': './models/model.ckpt'
 }
 
-same_seed(config['seed'])
-train_data, test_data = pd.read_csv("./covid_train.csv").values, pd.read_csv("./covid_test.csv").values
-train_data, valid_data = train_valid_split(train_data, config['valid_ratio'], config['seed'])
-
 # 在配置文件中新增参数
 config2 = {
-    'use_rf': True,  # 是否使用随机森林选特征
+    'use_rf': True,  # 是否在训练前输出随机森林的特征重要性
     'top_n': 20,  # 选择前N个重要特征
+    'corr_prefilter': 64,  # 随机森林之前按相关系数保留的候选特征数, None表示不预筛选
     'rf_params': {
         'n_estimators': 100,
         'max_depth': 5,
-        'random_state': config['seed']
+        'random_state': config['seed'],
+        'n_jobs': -1,
+        'max_samples': 0.5
     }
 }
 
-# 调整select_feat调用方式
-x_train, x_valid, x_test, y_train, y_valid = select_feat(
-    train_data,
-    valid_data,
-    test_data,
-)
-
-# 在训练前输出特征重要性
-if config2['use_rf']:
-    importance = np.array([
-        feature_importance(
-            torch.FloatTensor(x_train),
-            torch.FloatTensor(y_train)
-        )[i]
-        for i in range(x_train.shape[1])
-    ])
-
-    # 排序并显示前20个特征
-    sorted_indices = np.argsort(importance)[::-1]
-    print("Top 20 Important Features:")
-    for i in range(20):
-        print(f"{i + 1}. Feature {sorted_indices[i]}: {importance[sorted_indices[i]]:.4f}")
-print(f"""train_data size: {train_data.shape} 
+
+def main():
+    same_seed(config['seed'])
+    # 用pyarrow多线程解析CSV, 直接读成float32
+    train_data = pd.read_csv("./covid_train.csv", dtype=np.float32, engine='pyarrow').values
+    test_data = pd.read_csv("./covid_test.csv", dtype=np.float32, engine='pyarrow').values
+    train_data, valid_data = train_valid_split(train_data, config['valid_ratio'], config['seed'])
+
+    # 调整select_feat调用方式, 随机森林只训练一次
+    x_train, x_valid, x_test, y_train, y_valid, importance = select_feat(train_data, valid_data, test_data)
+
+    # 在训练前输出特征重要性
+    if config2['use_rf']:
+        # 排序并显示前20个特征
+        sorted_indices = np.argsort(importance)[::-1]
+        print("Top 20 Important Features:")
+        for i in range(20):
+            print(f"{i + 1}. Feature {sorted_indices[i]}: {importance[sorted_indices[i]]:.4f}")
+    print(f"""train_data size: {train_data.shape} 
 valid_data size: {valid_data.shape} 
 test_data size: {test_data.shape}""")
-x_train, x_valid, x_test, y_train, y_valid = select_feat(train_data, valid_data, test_data)
-print(f'number of features: {x_train.shape[1]}')
-
-train_dataset, valid_dataset, test_dataset = COVID19Dataset(x_train, y_train),COVID19Dataset(x_valid, y_valid),COVID19Dataset(x_test)
-
-# Pytorch data loader loads pytorch dataset into batches.
-train_loader = DataLoader(train_dataset, batch_size=config['batch_size'], shuffle=True, pin_memory=True)
-valid_loader = DataLoader(valid_dataset, batch_size=config['batch_size'], shuffle=True, pin_memory=True)
-test_loader = DataLoader(test_dataset, batch_size=config['batch_size'], shuffle=False, pin_memory=True)
-
-model = My_model(input_dim=x_train.shape[1]).to(device) # put your model and data on the same computation device.
-trainer(train_loader, valid_loader, model, config, device)
-
-model = My_model(input_dim=x_train.shape[1]).to(device)
-model.load_state_dict(torch.load(config['save_path']))
-preds = predict(test_loader, model, device)
-save_pred(preds, 'pred.csv')
+    print(f'number of features: {x_train.shape[1]}')
 
+    # 训练集和验证集很小, 一次性以连续的float32 tensor放到GPU上, 训练时直接在GPU上gather出batch, 不再经过Dataset/collate
+    X_train, Y_train = (torch.from_numpy(x_train).float().to(device).contiguous(),
+                        torch.from_numpy(y_train).float().to(device).unsqueeze(1).contiguous())
+    X_valid, Y_valid = (torch.from_numpy(x_valid).float().to(device).contiguous(),
+                        torch.from_numpy(y_valid).float().to(device).unsqueeze(1).contiguous())
+    test_dataset = COVID19Dataset(x_test)
 
+    # Pytorch data loader loads pytorch dataset into batches.
+    # 测试集只有几个batch且只遍历一次, 不开worker进程 (worker启动开销比整个预测还大)
+    test_loader = DataLoader(test_dataset, batch_size=config['batch_size'], shuffle=False, pin_memory=True)
 
+    model = My_model(input_dim=x_train.shape[1], n_replicas=config['n_replicas']).to(device) # put your model and data on the same computation device.
+    # 编译模型, 把Linear+ReLU融合成少量kernel; 整个训练step由trainer捕获成CUDA graph, 所以这里不用reduce-overhead模式
+    # 编译不可用(如Windows上没有Triton)时退回未编译的模型
+    model = compile_model(model, X_train[:config['batch_size']])
+    trainer((X_train, Y_train), (X_valid, Y_valid), model, config, device)
 
+    model = My_model(input_dim=x_train.shape[1], n_replicas=config['n_replicas']).to(device)
+    model.load_state_dict(torch.load(config['save_path']))
+    preds = predict(test_loader, model, device)
+    save_pred(preds, 'pred.csv')
 
 
+if __name__ == '__main__':
+    main()